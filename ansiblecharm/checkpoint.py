@@ -0,0 +1,166 @@
+"""Resume a failed playbook run from the task that failed.
+
+When a hook fails juju retries it, which re-runs every task of the
+tagged playbook. A :class:`Checkpoint` records which tasks finished and
+which one failed, keyed by a fingerprint of the run's inputs. A retry
+with the same fingerprint passes ``--start-at-task`` to skip the tasks
+that already succeeded; any change to the inputs gets a full run.
+
+Tasks are followed by reading the ``TASK [...]`` banners ansible prints.
+Handlers notified by the skipped tasks do not run again on resume, so a
+failure once handlers have started is not checkpointed. Runs use
+``--force-handlers`` so handlers notified before a failure run at once,
+which keeps a run with pending notifications from being checkpointed.
+Variables
+registered by skipped tasks are not set either, so a run is resumed at
+most once; if it fails again the next retry runs the whole playbook.
+"""
+from charmhelpers.core.hookenv import log
+from path import path
+import hashlib
+import re
+import subprocess
+import sys
+import yaml
+
+default_checkpoint_path = '/var/lib/ansiblecharm/checkpoint.yaml'
+
+task_banner = re.compile(r'^TASK:? \[(?P<name>.+)\]')
+handler_banner = re.compile(r'^(RUNNING HANDLER|NOTIFIED):? \[')
+
+# implicit fact gathering can't be targeted by --start-at-task
+fact_tasks = frozenset(('setup', 'Gathering Facts'))
+
+
+def fingerprint(call, vars_path, inputs=(), exclude=()):
+    """Return a digest of everything that feeds a playbook run.
+
+    That is the ansible-playbook command line, the vars file written for
+    this hook and every file under `inputs`, which should cover the
+    playbook tree with its roles and included files as well as any
+    module path. Hidden files, the ``.retry`` files ansible writes next
+    to a failed playbook and the paths in `exclude` are skipped.
+    """
+    exclude = set(path(x).abspath() for x in exclude)
+    digest = hashlib.sha256()
+    digest.update(' '.join(call).encode('utf-8'))
+    for input_path in [vars_path] + sorted(inputs):
+        for file_path in input_files(path(input_path)):
+            if file_path.abspath() in exclude:
+                continue
+            digest.update(file_path.encode('utf-8'))
+            digest.update(file_path.bytes())
+    return digest.hexdigest()
+
+
+def input_files(input_path):
+    if input_path.isfile():
+        yield input_path
+        return
+    if not input_path.isdir():
+        return
+    for child in sorted(input_path.listdir()):
+        if child.basename().startswith('.') or child.ext == '.retry':
+            continue
+        for file_path in input_files(child):
+            yield file_path
+
+
+def discard_checkpoint(checkpoint_path=default_checkpoint_path):
+    """Drop any saved progress so the next run is a full one."""
+    path(checkpoint_path).remove_p()
+
+
+class Checkpoint(object):
+    """Progress of the last failed run, stored as yaml in `checkpoint_path`."""
+
+    def __init__(self, fingerprint, checkpoint_path=default_checkpoint_path):
+        self.fingerprint = fingerprint
+        self.checkpoint_path = path(checkpoint_path)
+
+    def load(self):
+        """Return the saved progress if it matches this fingerprint."""
+        if not self.checkpoint_path.exists():
+            return {}
+        saved = yaml.safe_load(self.checkpoint_path.text()) or {}
+        if saved.get('fingerprint') != self.fingerprint:
+            return {}
+        return saved
+
+    def record(self, completed, failed):
+        self.checkpoint_path.parent.makedirs_p()
+        self.checkpoint_path.write_text(yaml.safe_dump({
+            'fingerprint': self.fingerprint,
+            'completed': completed,
+            'failed': failed,
+        }, default_flow_style=False))
+
+    def clear(self):
+        discard_checkpoint(self.checkpoint_path)
+
+    def run(self, call, env, stdout=sys.stdout):
+        """Run `call`, resuming from the saved failed task if any.
+
+        Raises subprocess.CalledProcessError like check_call on failure,
+        after recording how far the run got. A resumed run that doesn't
+        start at the saved task is stopped and replaced by a full run,
+        and a resumed run that fails again is not checkpointed, so the
+        next retry runs in full.
+        """
+        saved = self.load()
+        resume_at = saved.get('failed')
+        resume_call = call + ['--force-handlers']
+        if resume_at:
+            log('Resuming at task: %s' % resume_at, level="INFO")
+            resume_call += ['--start-at-task', resume_at]
+
+        proc = subprocess.Popen(resume_call, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        completed = []
+        current = None
+        resumed = False
+        for line in iter(proc.stdout.readline, ''):
+            stdout.write(line)
+            if handler_banner.match(line):
+                if current is not None:
+                    completed.append(current)
+                current = None
+                continue
+            match = task_banner.match(line)
+            if not match:
+                continue
+            if current is not None:
+                completed.append(current)
+            current = match.group('name')
+            if resume_at and not resumed and current not in fact_tasks:
+                if current != resume_at:
+                    proc.terminate()
+                    break
+                resumed = True
+        stdout.flush()
+
+        returncode = proc.wait()
+        if resume_at and not resumed:
+            log('Could not resume at task: %s; running in full' % resume_at,
+                level="WARNING")
+            self.clear()
+            return self.run(call, env, stdout)
+
+        if not returncode:
+            self.clear()
+            return
+
+        if current in fact_tasks:
+            current = None
+        if resume_at:
+            log('Resumed run failed; next run will be in full',
+                level="INFO")
+            self.clear()
+        elif current is None:
+            self.clear()
+        else:
+            log('Checkpointed at task: %s' % current, level="INFO")
+            self.record(completed, current)
+        raise subprocess.CalledProcessError(returncode, resume_call)
@@ -75,8 +75,12 @@ Read more online about `playbooks`_ and standard ansible `modules`_.
 
 """
 from . import state
+from .checkpoint import Checkpoint
+from .checkpoint import discard_checkpoint
+from .checkpoint import fingerprint
 from .helpers import hook_names
 from .helpers import write_hosts_file
+from .throttle import ExecutionPolicy
 from charmhelpers.core import hookenv
 from charmhelpers.core.hookenv import log
 from path import path
@@ -91,7 +95,8 @@ ansible_vars_path = '/etc/ansible/host_vars/localhost'
 
 
 def apply_playbook(playbook, tags=None, verbosity=0,
-                   module_path=None, write_hosts_file=write_hosts_file):
+                   module_path=None, write_hosts_file=write_hosts_file,
+                   checkpoint_path=None):
     tags = tags or []
     tags = ",".join(tags)
 
@@ -126,7 +131,20 @@ def apply_playbook(playbook, tags=None, verbosity=0,
         call.append("--module-path={}".format(module_path))
 
     log(' '.join(call), level="INFO")
-    subprocess.check_call(call, env=env)
+    if not checkpoint_path:
+        subprocess.check_call(call, env=env)
+        return
+
+    # the playbook tree holds the roles and included files
+    inputs = [os.path.dirname(os.path.abspath(playbook))]
+    if module_path:
+        inputs.extend(module_path.split(':'))
+
+    checkpoint = Checkpoint(
+        fingerprint(call, ansible_vars_path, inputs,
+                    exclude=[checkpoint_path]),
+        checkpoint_path)
+    checkpoint.run(call, env)
 
 
 class AnsibleHooks(hookenv.Hooks):
@@ -159,6 +177,25 @@ class AnsibleHooks(hookenv.Hooks):
         #     'playbooks/my_machine_state.yaml',
         #     default_hooks=['config-changed', 'start', 'stop'])
 
+        # To keep a large service from running the playbook on every unit
+        # at once after a config change, pass an ExecutionPolicy; each
+        # unit's config-changed is delayed by up to 60 seconds:
+        # hooks = AnsibleHooks(
+        #     'playbooks/my_machine_state.yaml',
+        #     policy=ExecutionPolicy(jitter=60))
+        #
+        # A concurrency budget across the service additionally needs a
+        # token backend shared by all units; the default token file only
+        # limits runs on the local machine:
+        # policy=ExecutionPolicy(jitter=60, concurrency=5,
+        #                        backend=shared_backend)
+
+        # Long playbooks can checkpoint their progress, so a retried hook
+        # resumes at the task that failed when its inputs are unchanged:
+        # hooks = AnsibleHooks(
+        #     'playbooks/my_machine_state.yaml',
+        #     checkpoint_path='/var/lib/ansiblecharm/checkpoint.yaml')
+
         if __name__ == "__main__":
             # execute a hook based on the name the program is called by
             hooks.execute(sys.argv)
@@ -173,7 +210,8 @@ class AnsibleHooks(hookenv.Hooks):
 
     def __init__(self, playbook_path,
                  default_hooks=None, hook_dir=None,
-                 merge_hooks=True, modules=None):
+                 merge_hooks=True, modules=None, policy=None,
+                 checkpoint_path=None):
         """Register any hooks handled by ansible."""
         super(AnsibleHooks, self).__init__()
 
@@ -183,6 +221,8 @@ class AnsibleHooks(hookenv.Hooks):
         self.playbook_path = playbook_path
         self.modules = isinstance(modules, basestring) and [modules]
         self.modules = self.modules or []
+        self.policy = policy or ExecutionPolicy()
+        self.checkpoint_path = checkpoint_path
 
         implicit_hooks = hook_dir and set(hook_names(self.hook_dir)) or set()
         default_hooks = default_hooks \
@@ -211,6 +251,12 @@ class AnsibleHooks(hookenv.Hooks):
         if any_tag is True:
             tags.append("any")
 
+        # a new charm revision may change files outside the playbook tree
+        if hook_name == 'upgrade-charm' and self.checkpoint_path:
+            discard_checkpoint(self.checkpoint_path)
+
         self.write_hosts_file()
-        self.playbook(self.playbook_path,
-                      tags=tags, verbosity=verbosity, module_path=modules)
+        with self.policy.slot(hook_name):
+            self.playbook(self.playbook_path,
+                          tags=tags, verbosity=verbosity, module_path=modules,
+                          checkpoint_path=self.checkpoint_path)
@@ -0,0 +1,259 @@
+from path import path
+import mock
+import shutil
+import six
+import subprocess
+import tempfile
+import unittest
+import yaml
+
+
+class CheckpointTestCase(unittest.TestCase):
+
+    call = ['ansible-playbook', '-c', 'local', 'site.yaml',
+            '--tags', 'install']
+    full_call = call + ['--force-handlers']
+
+    def makeone(self, fingerprint='abc'):
+        from ansiblecharm import checkpoint
+        patcher = mock.patch.object(checkpoint, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        var_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, var_dir)
+        self.checkpoint_path = path(var_dir) / 'checkpoint.yaml'
+        return checkpoint.Checkpoint(fingerprint, self.checkpoint_path)
+
+    def setUp(self):
+        super(CheckpointTestCase, self).setUp()
+        patcher = mock.patch('ansiblecharm.checkpoint.subprocess.Popen')
+        self.mock_popen = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runs = []
+        self.procs = []
+        self.mock_popen.side_effect = self.popen
+
+    def popen(self, *args, **kwargs):
+        "dummy Popen replaying the next scripted ansible run"
+        output, returncode = self.runs.pop(0)
+        output = list(output)
+        proc = mock.Mock(name='proc')
+        proc.stdout.readline.side_effect = lambda: (
+            output.pop(0) if output else '')
+        proc.wait.return_value = returncode
+        self.procs.append(proc)
+        return proc
+
+    def run_playbook(self, checkpoint, output, returncode=0, runs=()):
+        self.runs = [(output, returncode)] + list(runs)
+        checkpoint.run(self.call, {}, stdout=six.StringIO())
+        return self.mock_popen.call_args_list[0][0][0]
+
+    def saved(self):
+        return yaml.safe_load(self.checkpoint_path.text())
+
+    def test_records_failed_task(self):
+        checkpoint = self.makeone()
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_playbook(checkpoint, [
+                'TASK [setup] ****\n',
+                'ok: [localhost]\n',
+                'TASK [Install packages] ****\n',
+                'ok: [localhost]\n',
+                'TASK [Build assets] ****\n',
+                'fatal: [localhost]: FAILED!\n',
+            ], returncode=2)
+
+        self.assertEqual(self.saved(), {
+            'fingerprint': 'abc',
+            'completed': ['setup', 'Install packages'],
+            'failed': 'Build assets',
+        })
+
+    def test_resumes_at_failed_task(self):
+        checkpoint = self.makeone()
+        checkpoint.record(['Install packages'], 'Build assets')
+
+        call = self.run_playbook(checkpoint, [
+            'TASK: [Build assets] ****\n',
+            'ok: [localhost]\n',
+        ])
+
+        self.assertEqual(
+            call, self.full_call + ['--start-at-task', 'Build assets'])
+        assert not self.checkpoint_path.exists()
+
+    def test_full_run_when_inputs_change(self):
+        checkpoint = self.makeone()
+        checkpoint.record(['Install packages'], 'Build assets')
+        checkpoint.fingerprint = 'changed'
+
+        call = self.run_playbook(checkpoint, [])
+
+        self.assertEqual(call, self.full_call)
+
+    def test_resumes_after_fact_gathering(self):
+        checkpoint = self.makeone()
+        checkpoint.record(['Install packages'], 'Build assets')
+
+        self.run_playbook(checkpoint, [
+            'TASK [Gathering Facts] ****\n',
+            'TASK [Build assets] ****\n',
+        ])
+
+        self.assertEqual(self.mock_popen.call_count, 1)
+
+    def test_full_run_when_resume_matches_nothing(self):
+        checkpoint = self.makeone()
+        checkpoint.record(['Install packages'], 'Build {{ app }}')
+
+        self.run_playbook(checkpoint, [
+            'PLAY RECAP ****\n',
+        ], runs=[([
+            'TASK [Install packages] ****\n',
+            'TASK [Build web] ****\n',
+        ], 0)])
+
+        calls = [args[0][0] for args in self.mock_popen.call_args_list]
+        self.assertEqual(calls, [
+            self.full_call + ['--start-at-task', 'Build {{ app }}'],
+            self.full_call,
+        ])
+        assert not self.checkpoint_path.exists()
+
+    def test_full_run_when_resumed_at_other_task(self):
+        checkpoint = self.makeone()
+        checkpoint.record([], 'Build*')
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_playbook(checkpoint, [
+                'TASK [Build docs] ****\n',
+            ], returncode=-15, runs=[([
+                'TASK [Build assets] ****\n',
+            ], 2)])
+
+        assert self.procs[0].terminate.called
+        self.assertEqual(self.mock_popen.call_args_list[1][0][0],
+                         self.full_call)
+        self.assertEqual(self.saved()['failed'], 'Build assets')
+
+    def test_resumed_run_failing_again_runs_in_full_next(self):
+        checkpoint = self.makeone()
+        checkpoint.record(['Register version'], 'Build assets')
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_playbook(checkpoint, [
+                'TASK [Build assets] ****\n',
+                'fatal: [localhost]: FAILED! version is undefined\n',
+            ], returncode=2)
+
+        assert not self.checkpoint_path.exists()
+
+        self.run_playbook(checkpoint, [])
+        self.assertEqual(self.mock_popen.call_args[0][0], self.full_call)
+
+    def test_no_checkpoint_for_failed_handler(self):
+        checkpoint = self.makeone()
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_playbook(checkpoint, [
+                'TASK [Write config] ****\n',
+                'RUNNING HANDLER [restart app] ****\n',
+                'fatal: [localhost]: FAILED!\n',
+            ], returncode=2)
+
+        assert not self.checkpoint_path.exists()
+
+    def test_no_checkpoint_with_pending_handlers(self):
+        checkpoint = self.makeone()
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_playbook(checkpoint, [
+                'TASK [Write config] ****\n',
+                'changed: [localhost]\n',
+                'TASK [Build assets] ****\n',
+                'fatal: [localhost]: FAILED!\n',
+                'RUNNING HANDLER [restart app] ****\n',
+                'changed: [localhost]\n',
+            ], returncode=2)
+
+        assert not self.checkpoint_path.exists()
+
+    def test_no_checkpoint_for_fact_gathering(self):
+        checkpoint = self.makeone()
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_playbook(checkpoint, [
+                'TASK [Gathering Facts] ****\n',
+                'fatal: [localhost]: UNREACHABLE!\n',
+            ], returncode=3)
+
+        assert not self.checkpoint_path.exists()
+
+
+class FingerprintTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(FingerprintTestCase, self).setUp()
+        var_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, var_dir)
+        self.charm_dir = path(var_dir) / 'charm'
+        self.playbook = self.charm_dir / 'playbooks' / 'site.yaml'
+        self.role_task = (self.charm_dir / 'playbooks' / 'roles' / 'app' /
+                          'tasks' / 'main.yaml')
+        self.role_task.parent.makedirs_p()
+        self.role_task.write_text('- name: Build assets\n')
+        self.playbook.write_text('- hosts: localhost\n')
+        self.vars_path = path(var_dir) / 'localhost'
+        self.vars_path.write_text('port: 80\n')
+
+    def fingerprint(self, call=('ansible-playbook', 'site.yaml'), **kw):
+        from ansiblecharm.checkpoint import fingerprint
+        return fingerprint(list(call), self.vars_path,
+                           [self.playbook.parent], **kw)
+
+    def test_stable_for_same_inputs(self):
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_changes_with_vars(self):
+        before = self.fingerprint()
+        self.vars_path.write_text('port: 8080\n')
+        self.assertNotEqual(before, self.fingerprint())
+
+    def test_changes_with_playbook(self):
+        before = self.fingerprint()
+        self.playbook.write_text('- hosts: all\n')
+        self.assertNotEqual(before, self.fingerprint())
+
+    def test_changes_with_roles(self):
+        before = self.fingerprint()
+        self.role_task.write_text('- name: Build all assets\n')
+        self.assertNotEqual(before, self.fingerprint())
+
+    def test_changes_with_new_files(self):
+        before = self.fingerprint()
+        templates = self.playbook.parent / 'templates'
+        templates.makedirs_p()
+        (templates / 'app.conf').write_text('x\n')
+        self.assertNotEqual(before, self.fingerprint())
+
+    def test_ignores_hidden_files(self):
+        before = self.fingerprint()
+        (self.playbook.parent / '.git').makedirs_p()
+        (self.playbook.parent / '.git' / 'HEAD').write_text('ref\n')
+        self.assertEqual(before, self.fingerprint())
+
+    def test_ignores_retry_files(self):
+        before = self.fingerprint()
+        (self.playbook.parent / 'site.retry').write_text('localhost\n')
+        self.assertEqual(before, self.fingerprint())
+
+    def test_ignores_excluded_paths(self):
+        checkpoint_path = self.playbook.parent / 'checkpoint.yaml'
+        before = self.fingerprint(exclude=[checkpoint_path])
+        checkpoint_path.write_text('failed: Build assets\n')
+        self.assertEqual(before, self.fingerprint(exclude=[checkpoint_path]))
+
+    def test_changes_with_tags(self):
+        self.assertNotEqual(
+            self.fingerprint(),
+            self.fingerprint(('ansible-playbook', 'site.yaml',
+                              '--tags', 'install')))
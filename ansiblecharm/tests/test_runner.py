@@ -195,3 +195,62 @@ class ApplyPlaybookTestCases(unittest.TestCase):
                 'ansible-playbook', '-c', 'local', '-v', 'my/playbook.yaml',
                 '--tags', 'start'], env={'PYTHONUNBUFFERED': '1'})
             assert self.wfh_mock.called
+
+    def test_hooks_run_playbook_within_policy(self):
+        ansible, hookenv = self.makeone()
+        policy = mock.MagicMock(name='policy')
+
+        def check_slot_held(*args, **kwargs):
+            assert policy.slot.return_value.__enter__.called
+            assert not policy.slot.return_value.__exit__.called
+        self.mock_subprocess.check_call.side_effect = check_slot_held
+
+        with mock.patch.object(hookenv, 'config'):
+            hooks = ansible.AnsibleHooks(
+                'my/playbook.yaml', default_hooks=['config-changed'],
+                policy=policy)
+
+            hooks.execute(['config-changed'])
+
+            self.assertEqual(self.mock_subprocess.check_call.call_count, 1)
+            policy.slot.assert_called_once_with('config-changed')
+            assert policy.slot.return_value.__exit__.called
+
+    def test_checkpointed_run(self):
+        ansible, hookenv = self.makeone()
+        checkpoint_path = os.path.join(
+            os.path.dirname(self.vars_path), 'checkpoint.yaml')
+        with mock.patch.object(ansible.Checkpoint, 'run') as run:
+            with mock.patch.object(ansible, 'fingerprint') as fingerprint:
+                ansible.apply_playbook('playbooks/dependencies.yaml',
+                                       module_path='/charm/modules',
+                                       checkpoint_path=checkpoint_path)
+
+            call = [
+                'ansible-playbook', '-c', 'local',
+                'playbooks/dependencies.yaml',
+                '--module-path=/charm/modules']
+            run.assert_called_once_with(call, {'PYTHONUNBUFFERED': '1'})
+            fingerprint.assert_called_once_with(
+                call, self.vars_path,
+                [os.path.abspath('playbooks'), '/charm/modules'],
+                exclude=[checkpoint_path])
+        self.assertEqual(self.mock_subprocess.check_call.call_count, 0)
+
+    def test_upgrade_charm_clears_checkpoint(self):
+        ansible, hookenv = self.makeone()
+        var_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, var_dir)
+        checkpoint_path = os.path.join(var_dir, 'checkpoint.yaml')
+        with open(checkpoint_path, 'w') as fp:
+            fp.write('failed: Build assets\n')
+
+        with mock.patch.object(hookenv, 'config'):
+            hooks = ansible.AnsibleHooks(
+                'my/playbook.yaml', default_hooks=['upgrade-charm'],
+                checkpoint_path=checkpoint_path)
+
+            with mock.patch.object(ansible.Checkpoint, 'run'):
+                hooks.execute(['upgrade-charm'])
+
+        self.assertFalse(os.path.exists(checkpoint_path))
@@ -0,0 +1,204 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class StubBackend(object):
+    """Stand-in for the shared coordination point of a token budget."""
+
+    def __init__(self, free=None):
+        self.free = free
+        self.held = []
+        self.released = []
+        self.calls = 0
+
+    def acquire(self, budget, owner):
+        self.calls += 1
+        if self.free is not None:
+            if not self.free:
+                return None
+            self.free -= 1
+        if len(self.held) >= budget:
+            return None
+        token = '%s-token' % owner
+        self.held.append(token)
+        return token
+
+    def release(self, token):
+        self.held.remove(token)
+        self.released.append(token)
+
+
+class UnitJitterTestCase(unittest.TestCase):
+
+    def test_deterministic_per_unit(self):
+        from ansiblecharm.throttle import unit_jitter
+        self.assertEqual(unit_jitter(60, 'svc/1'), unit_jitter(60, 'svc/1'))
+        self.assertNotEqual(unit_jitter(60, 'svc/1'),
+                            unit_jitter(60, 'svc/2'))
+
+    def test_within_window(self):
+        from ansiblecharm.throttle import unit_jitter
+        for num in range(100):
+            delay = unit_jitter(30, 'svc/%d' % num)
+            assert 0 <= delay < 30
+
+    def test_no_window(self):
+        from ansiblecharm.throttle import unit_jitter
+        self.assertEqual(unit_jitter(0, 'svc/1'), 0)
+
+    @mock.patch('charmhelpers.core.hookenv.local_unit')
+    def test_defaults_to_local_unit(self, local_unit):
+        from ansiblecharm.throttle import unit_jitter
+        local_unit.return_value = 'svc/3'
+        self.assertEqual(unit_jitter(60), unit_jitter(60, 'svc/3'))
+
+
+class ExecutionPolicyTestCase(unittest.TestCase):
+
+    def makeone(self, **kw):
+        from ansiblecharm import throttle
+        patcher = mock.patch.object(throttle, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        policy = throttle.ExecutionPolicy(**kw)
+        policy.sleep = mock.Mock(name='sleep')
+        return policy
+
+    def test_noop_by_default(self):
+        policy = self.makeone()
+        with policy.slot('config-changed', 'svc/1'):
+            pass
+        self.assertEqual(policy.sleep.call_count, 0)
+
+    def test_only_applies_to_listed_hooks(self):
+        policy = self.makeone(jitter=60)
+        with policy.slot('install', 'svc/1'):
+            pass
+        self.assertEqual(policy.sleep.call_count, 0)
+
+    def test_applies_to_every_hook(self):
+        policy = self.makeone(jitter=60, hooks=None)
+        with policy.slot('install', 'svc/1'):
+            pass
+        self.assertEqual(policy.sleep.call_count, 1)
+
+    def test_sleeps_for_unit_jitter(self):
+        from ansiblecharm.throttle import unit_jitter
+        policy = self.makeone(jitter=60)
+        with policy.slot('config-changed', 'svc/1'):
+            pass
+        policy.sleep.assert_called_once_with(unit_jitter(60, 'svc/1'))
+
+    def test_holds_token_while_running(self):
+        backend = StubBackend()
+        policy = self.makeone(concurrency=2, backend=backend)
+        with policy.slot('config-changed', 'svc/1'):
+            self.assertEqual(backend.held, ['svc/1-token'])
+        self.assertEqual(backend.held, [])
+        self.assertEqual(backend.released, ['svc/1-token'])
+
+    def test_releases_token_on_failure(self):
+        backend = StubBackend()
+        policy = self.makeone(concurrency=1, backend=backend)
+        with self.assertRaises(ValueError):
+            with policy.slot('config-changed', 'svc/1'):
+                raise ValueError()
+        self.assertEqual(backend.held, [])
+
+    def test_waits_for_free_token(self):
+        backend = StubBackend()
+        backend.held.append('svc/0-token')
+        policy = self.makeone(concurrency=1, backend=backend,
+                              poll_interval=3)
+
+        def free_slot(seconds):
+            backend.release('svc/0-token')
+        policy.sleep.side_effect = free_slot
+
+        with policy.slot('config-changed', 'svc/1'):
+            self.assertEqual(backend.held, ['svc/1-token'])
+        policy.sleep.assert_called_once_with(3)
+        self.assertEqual(backend.calls, 2)
+
+    def test_gives_up_after_timeout(self):
+        from ansiblecharm.throttle import BudgetExhausted
+        backend = StubBackend(free=0)
+        policy = self.makeone(concurrency=1, backend=backend,
+                              poll_interval=5, timeout=10)
+        with self.assertRaises(BudgetExhausted):
+            with policy.slot('config-changed', 'svc/1'):
+                pass
+        self.assertEqual(policy.sleep.call_count, 2)
+
+    def test_gives_up_by_default(self):
+        from ansiblecharm.throttle import BudgetExhausted
+        backend = StubBackend(free=0)
+        policy = self.makeone(concurrency=1, backend=backend)
+        with self.assertRaises(BudgetExhausted):
+            with policy.slot('config-changed', 'svc/1'):
+                pass
+        self.assertEqual(policy.sleep.call_count,
+                         policy.timeout // policy.poll_interval)
+
+
+class TokenFileBackendTestCase(unittest.TestCase):
+
+    def makeone(self):
+        from ansiblecharm import throttle
+        patcher = mock.patch.object(throttle, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        token_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, token_dir)
+        return throttle.TokenFileBackend(token_dir)
+
+    def test_hands_out_budget(self):
+        backend = self.makeone()
+        first = backend.acquire(2, 'svc/1')
+        second = backend.acquire(2, 'svc/2')
+        assert first != second
+        self.assertEqual(backend.acquire(2, 'svc/3'), None)
+
+        backend.release(first)
+        self.assertEqual(backend.acquire(2, 'svc/3'), first)
+
+    def test_token_records_owner(self):
+        backend = self.makeone()
+        token = backend.acquire(1, 'svc/1')
+        self.assertEqual(token.text(), 'svc/1 %d' % os.getpid())
+
+        backend.release(token)
+        self.assertEqual(token.text(), '')
+
+    def test_token_not_inherited(self):
+        import fcntl
+        backend = self.makeone()
+        token = backend.acquire(1, 'svc/1')
+        flags = fcntl.fcntl(backend.held[token], fcntl.F_GETFD)
+        assert flags & fcntl.FD_CLOEXEC
+
+    def test_abandoned_token_is_free(self):
+        backend = self.makeone()
+        token = backend.acquire(1, 'svc/1')
+
+        # the lock goes away with the process holding it
+        os.close(backend.held.pop(token))
+
+        self.assertEqual(backend.acquire(1, 'svc/2'), token)
+        self.assertEqual(token.text(), 'svc/2 %d' % os.getpid())
+
+    def test_release_ignores_foreign_token(self):
+        backend = self.makeone()
+        other = self.makeone()
+        other.token_dir = backend.token_dir
+        token = other.acquire(1, 'svc/1')
+
+        backend.release(token)
+
+        self.assertEqual(backend.acquire(1, 'svc/2'), None)
+        self.assertEqual(token.text(), 'svc/1 %d' % os.getpid())
@@ -0,0 +1,165 @@
+"""Spread fleet-wide playbook runs out over time.
+
+A single ``juju set`` makes every unit of a service run ``config-changed``
+at once. An :class:`ExecutionPolicy` delays each unit by a deterministic
+jitter derived from its unit name and caps how many playbook runs may
+proceed at the same time through a token budget.
+
+The default :class:`TokenFileBackend` only coordinates processes that
+share its token directory, which in practice means a single machine.
+Units of a service live on separate machines, so a fleet-wide cap needs
+a backend with a shared coordination point.
+"""
+from charmhelpers.core import hookenv
+from charmhelpers.core.hookenv import log
+from contextlib import contextmanager
+from path import path
+import errno
+import fcntl
+import hashlib
+import os
+import time
+
+default_token_dir = '/var/lib/ansiblecharm/tokens'
+
+
+class BudgetExhausted(Exception):
+    """No execution token became available before the timeout."""
+
+
+def unit_jitter(max_delay, unit=None):
+    """Return a delay in seconds between 0 and `max_delay` for `unit`.
+
+    The delay is derived from a hash of the unit name, so a unit always
+    waits the same amount of time while its peers are spread evenly
+    across the window.
+    """
+    if not max_delay:
+        return 0
+    unit = unit or hookenv.local_unit()
+    digest = hashlib.sha1(unit.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / float(0x100000000) * max_delay
+
+
+class TokenFileBackend(object):
+    """Hand out execution tokens as locked files in `token_dir`.
+
+    Each token is a ``slot-N`` file held under an exclusive ``flock``
+    and naming its owner and pid. The kernel drops the lock when the
+    holding process dies, so abandoned tokens free themselves.
+
+    Only processes sharing `token_dir` are limited by the budget.
+    """
+
+    def __init__(self, token_dir=default_token_dir):
+        self.token_dir = path(token_dir)
+        self.held = {}
+
+    def acquire(self, budget, owner):
+        """Return a token if one of `budget` slots is free, else None."""
+        self.token_dir.makedirs_p()
+        for slot in range(budget):
+            token = self.token_dir / ('slot-%d' % slot)
+            fd = os.open(token, os.O_CREAT | os.O_RDWR, 0o644)
+            # keep ansible-playbook and its children from inheriting the lock
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                continue
+            os.ftruncate(fd, 0)
+            os.write(fd, ('%s %d' % (owner, os.getpid())).encode('utf-8'))
+            self.held[token] = fd
+            return token
+        return None
+
+    def release(self, token):
+        fd = self.held.pop(token, None)
+        if fd is None:
+            log('Not releasing token %s held by another process' % token,
+                level="WARNING")
+            return
+        os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class ExecutionPolicy(object):
+    """Jitter and rate-limit playbook runs across the units of a service.
+
+    Example::
+
+        policy = ExecutionPolicy(jitter=60, concurrency=5,
+                                 backend=shared_backend)
+        hooks = AnsibleHooks('playbooks/site.yaml', policy=policy)
+
+    `jitter` is the width in seconds of the window units are spread
+    across. `concurrency` is the number of runs allowed to hold a token
+    at once; None disables the budget. `backend` is the coordination
+    point handing out tokens and defaults to a :class:`TokenFileBackend`
+    in `token_dir`, which only limits runs on the local machine. Pass a
+    backend shared by all units for a fleet-wide cap; any object with
+    ``acquire(budget, owner)`` and ``release(token)`` will do. A run
+    that can't get a token within `timeout` seconds raises
+    :class:`BudgetExhausted` so the hook fails and juju retries it later.
+
+    The policy only applies to the hooks named in `hooks`, by default
+    ``config-changed``; None applies it to every hook.
+    """
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, jitter=0, concurrency=None,
+                 token_dir=default_token_dir, backend=None,
+                 poll_interval=5, timeout=300, hooks=('config-changed',)):
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.backend = backend or TokenFileBackend(token_dir)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.hooks = hooks
+
+    def applies(self, hook_name):
+        if not (self.jitter or self.concurrency):
+            return False
+        return self.hooks is None or hook_name in self.hooks
+
+    @contextmanager
+    def slot(self, hook_name, unit=None):
+        """Wait for this unit's turn and hold a token for the block."""
+        if not self.applies(hook_name):
+            yield
+            return
+
+        unit = unit or hookenv.local_unit()
+        delay = unit_jitter(self.jitter, unit)
+        if delay:
+            log('Delaying %s by %.1fs' % (unit, delay), level="INFO")
+            self.sleep(delay)
+
+        if not self.concurrency:
+            yield
+            return
+
+        token = self.acquire(unit)
+        try:
+            yield
+        finally:
+            self.backend.release(token)
+
+    def acquire(self, unit):
+        waited = 0
+        while True:
+            token = self.backend.acquire(self.concurrency, unit)
+            if token is not None:
+                log('%s acquired token %s' % (unit, token), level="DEBUG")
+                return token
+            if self.timeout is not None and waited >= self.timeout:
+                raise BudgetExhausted(
+                    '%s waited %ss for one of %d tokens'
+                    % (unit, waited, self.concurrency))
+            log('%s waiting for a token' % unit, level="DEBUG")
+            self.sleep(self.poll_interval)
+            waited += self.poll_interval